@@ -1,5 +1,5 @@
 # -*- coding: utf-8 -*-
-
+"""
 Consider the given data on the trajectory of Michaelis-Menten nonlinear ODE system over the
 combination of phase-spaces in (X, P, V, S, E). Compute the most probable values of eta, kappa, and
 epsilon along the arclength in the respective phase-spaces for the given start and end times.
@@ -12,29 +12,29 @@ ARC LENGTH START tau = 0.2 ATCLENGTH END tau = 4.8 \\
 P,V
 """
 
-import numpy as np
 import itertools
-import matplotlib.pyplot as plt
+
+import numpy as np
+
+import instrument
 
 """Put your dataset here."""
 
-PP = [0.0, 0.035, 0.0632625, 0.0910443, 0.118258, 0.144906, 0.170989, 0.196507, 0.221461, 0.245853, 0.269684, 0.292957, 0.315675, 0.337841, 0.35946, 0.380535, 0.40107, 0.421072, 0.440545, 0.459496, 0.47793, 0.495855, 0.513277, 0.530204, 0.546642, 0.5626, 0.578086, 0.593108, 0.607675, 0.621795, 0.635477, 0.648729, 0.661562, 0.673984, 0.686005, 0.697633, 0.708878, 0.71975, 0.730257, 0.740409, 0.750215, 0.759684, 0.768826, 0.77765, 0.786164, 0.794378, 0.802299, 0.809938, 0.817302, 0.824399, 0.831238, 0.837828, 0.844175, 0.850288, 0.856174, 0.861841, 0.867295, 0.872545, 0.877597, 0.882457, 0.887132, 0.89163, 0.895955, 0.900113, 0.904112, 0.907956, 0.911651, 0.915203, 0.918616, 0.921896, 0.925047, 0.928075, 0.930983, 0.933777, 0.93646, 0.939037, 0.941512, 0.943889, 0.946171, 0.948362]
+P = [0.0, 0.035, 0.0632625, 0.0910443, 0.118258, 0.144906, 0.170989, 0.196507, 0.221461, 0.245853, 0.269684, 0.292957, 0.315675, 0.337841, 0.35946, 0.380535, 0.40107, 0.421072, 0.440545, 0.459496, 0.47793, 0.495855, 0.513277, 0.530204, 0.546642, 0.5626, 0.578086, 0.593108, 0.607675, 0.621795, 0.635477, 0.648729, 0.661562, 0.673984, 0.686005, 0.697633, 0.708878, 0.71975, 0.730257, 0.740409, 0.750215, 0.759684, 0.768826, 0.77765, 0.786164, 0.794378, 0.802299, 0.809938, 0.817302, 0.824399, 0.831238, 0.837828, 0.844175, 0.850288, 0.856174, 0.861841, 0.867295, 0.872545, 0.877597, 0.882457, 0.887132, 0.89163, 0.895955, 0.900113, 0.904112, 0.907956, 0.911651, 0.915203, 0.918616, 0.921896, 0.925047, 0.928075, 0.930983, 0.933777, 0.93646, 0.939037, 0.941512, 0.943889, 0.946171, 0.948362]
 V = [0.0, 0.35, 0.282625, 0.277818, 0.272137, 0.266482, 0.260828, 0.255179, 0.24954, 0.243916, 0.238312, 0.232732, 0.227181, 0.221664, 0.216184, 0.210747, 0.205357, 0.200017, 0.194733, 0.189507, 0.184344, 0.179247, 0.174219, 0.169264, 0.164384, 0.159582, 0.15486, 0.150221, 0.145667, 0.141199, 0.136819, 0.132529, 0.128329, 0.124221, 0.120205, 0.116282, 0.112452, 0.108714, 0.105071, 0.10152, 0.0980612, 0.0946949, 0.0914199, 0.0882356, 0.085141, 0.0821351, 0.0792168, 0.0763848, 0.0736379, 0.0709747, 0.0683936, 0.0658934, 0.0634722, 0.0611287, 0.0588611, 0.0566677, 0.054547, 0.052497, 0.0505163, 0.0486029, 0.0467551, 0.0449714, 0.0432498, 0.0415887, 0.0399863, 0.0384411, 0.0369512, 0.0355151, 0.0341311, 0.0327977, 0.0315132, 0.0302761, 0.0290848, 0.0279379, 0.026834, 0.0257715, 0.0247492, 0.0237655, 0.0228194, 0.0219093]
 
 t = [i/10 for i in range(80)]
 
-"""Change the plot variable based on your data."""
-
-plt.plot(P, V)
-plt.xlabel("P")
-plt.ylabel("V")
-plt.title("Trajectory of Michaelis-Menten System")
-plt.show()
-
-a = [i/10 for i in range(1, 16)]
-combinations = list(itertools.product(a, repeat=3))
+@instrument.timed('mm.simulate')
+def michaelis_menten_kinetics(eta,kappa,eps,delt,tott,sens=False):
+    """
+    Euler trajectory out[i] = [tau,X,P,S,E,V] and dX/dtau.
 
-def michaelis_menten_kinetics(eta,kappa,eps,delt,tott):
+    With sens=True the forward sensitivities of the Euler map are carried
+    along and returned as a third value dout (trs x 6 x 3), where
+    dout[i,j,k] is the exact derivative of out[i,j] with respect to
+    (eta, kappa, eps)[k].
+    """
     X0,P0,tau = 0,0,0
     trs = int(tott/delt)
     out = np.zeros((trs,6))
@@ -42,19 +42,135 @@ def michaelis_menten_kinetics(eta,kappa,eps,delt,tott):
     Xtau,Ptau,Stau,Etau,Vtau = X0,P0,1.0,1.0,0
     i = 0
 
+    if sens:
+        dout = np.zeros((trs,6,3))
+        sX = np.zeros(3)
+        sP = np.zeros(3)
+        # d(eps*X)/dtheta = eps*sX + X*e_eps
+        e_eps = np.array([0.0,0.0,1.0])
+
     while (i < trs):
         out[i,0:6] = [tau,Xtau,Ptau,Stau,Etau,Vtau]
+        if sens:
+            sV = eps*sX + Xtau*e_eps
+            dout[i,1:6] = [sX,sP,-sV-sP,-sX,sV]
+
+            f = (1-Xtau)*(1-eps*Xtau-Ptau)-(eta+kappa)*Xtau
+            f_X = -(1-eps*Xtau-Ptau) - eps*(1-Xtau) - (eta+kappa)
+            f_P = -(1-Xtau)
+            f_theta = np.array([-Xtau,-Xtau,-Xtau*(1-Xtau)])
+            sX = sX + delt * (f_X*sX + f_P*sP + f_theta) / eta
+            # the 1/eta factor of the X update
+            sX[0] = sX[0] - delt*f/eta**2
         Xtau = Xtau + delt * ((1-Xtau)*(1-eps*Xtau-Ptau)-(eta+kappa)*Xtau) / eta
         Ptau = Ptau + delt*eps*Xtau
+        if sens:
+            sP = sP + delt*(eps*sX + Xtau*e_eps)
         Etau = 1-Xtau
         Stau = 1-eps*Xtau-Ptau
         Vtau = eps*Xtau
         tau = tau + delt
         i = i+1
 
+    instrument.count('mm.simulations')
+    instrument.count('mm.steps', trs)
+
     dxdt = np.diff(out[:,1])/np.diff(out[:,0])
+    if sens:
+        return (out,dxdt,dout)
     return (out,dxdt)
 
+def michaelis_menten_sse(y_dat,eta,kappa,eps,col=2,delt=0.1):
+    """
+    Squared error of column col against y_dat from one augmented simulation,
+    with its exact gradient and the Gauss-Newton Jacobian d y_hat / d theta
+    (m x 3) over theta = (eta, kappa, eps).
+    """
+    y_dat = np.asarray(y_dat,dtype=float)
+    m = len(y_dat)
+    res,dxdt,dres = michaelis_menten_kinetics(eta,kappa,eps,delt,(m+1)*delt,sens=True)
+    r = res[:m,col] - y_dat
+    J = dres[:m,col,:]
+    return (r@r,2*J.T@r,J)
+
+"""You'll need to change col based on your dataset \\
+col = 1 for X \\
+col = 2 for P \\
+col = 3 for S \\
+col = 4 for E \\
+col = 5 for V \\
+"""
+
+@instrument.timed('mm.grid')
+def michaelis_menten_grid(y_dat,a=None,col=2,delt=0.1,tott=8):
+    """
+    Squared error of column col against y_dat for every (eta, kappa, eps)
+    in a x a x a, by default (0.1, 1.5) in steps of 0.1.
+    """
+    if a is None:
+        a = [i/10 for i in range(1, 16)]
+    y_dat = np.asarray(y_dat,dtype=float)
+    combinations = list(itertools.product(a, repeat=3))
+    error = []
+    # corners of the grid blow up and leave a NaN error; pick with np.nanargmin
+    with np.errstate(over='ignore',invalid='ignore'):
+        for eta,kappa,eps in combinations:
+            res,dxdt = michaelis_menten_kinetics(eta,kappa,eps,delt,tott)
+            error.append(np.sum((res[:len(y_dat),col] - y_dat)**2))
+    return (combinations,error)
+
+@instrument.timed('mm.lm')
+def michaelis_menten_lm(y_dat,p_init,col=2,delt=0.1):
+    """
+    Refine (eta, kappa, eps) from a grid optimum with the Levenberg-Marquardt
+    engine of Project5, using column col of the simulation as the model.
+
+    Returns the fitted parameters (3 x 1), their standard errors, the
+    correlation matrix and the reduced Chi-squared.
+    """
+    from Project5 import lm
+
+    y_dat = np.asarray(y_dat,dtype=float)
+    t_dat = np.arange(len(y_dat))*delt
+
+    # one augmented simulation gives both the model and its exact Jacobian;
+    # keep the last one since lm asks for them at the same p in turn
+    last = {}
+
+    def simulate(t,p):
+        key = (len(t),p.tobytes())
+        if last.get('key') != key:
+            # one extra step so int(tott/delt) never rounds below len(t)
+            res,dxdt,dres = michaelis_menten_kinetics(p[0,0],p[1,0],p[2,0],delt,(len(t)+1)*delt,sens=True)
+            last['key'] = key
+            last['y'] = res[:len(t),col]
+            last['J'] = dres[:len(t),col,:]
+        return last
+
+    def mm_func(t,p):
+        return simulate(t,p)['y']
+
+    def mm_jac(t,p):
+        return simulate(t,p)['J']
+
+    p_init = np.array([p_init],dtype=float).T
+    # eta divides the X update, keep all three rates positive
+    p_min = np.full((3,1),1e-3)
+    p_max = 100*abs(p_init)
+    # JtWdy is scaled by 1/(y.y), so the default gradient tolerance stops
+    # long before the parameters settle
+    p_fit,redX2,sigma_p,sigma_y,corr_p,R_sq,cvg_hst,JtWJ,inv = lm(p_init,t_dat,y_dat,mm_func,p_min,p_max,1e-12,mm_jac)
+    return (p_fit,sigma_p,corr_p,redX2)
+
+def michaelis_menten_fit(y_dat,a=(0.3,0.8,1.3),col=2,delt=0.1):
+    """
+    Coarse grid over a for (eta, kappa, eps), then LM refinement of the best
+    grid point. The default grid costs 27 simulations instead of 3,375.
+    """
+    combinations,error = michaelis_menten_grid(y_dat,a,col,delt,(len(y_dat)+1)*delt)
+    # unstable Euler steps at small eta give NaN errors
+    return michaelis_menten_lm(y_dat,combinations[int(np.nanargmin(error))],col,delt)
+
 """You'll need to change the j in res[i, j] based on your dataset \\
 j = 1 for X \\
 j = 2 for P \\
@@ -69,63 +185,62 @@ def arclength(start, end, res):
     arclength += np.sqrt((res[i,2] - res[i+1,2])**2 + (res[i,5]-res[i+1,5])**2) # change here - VP is 2,5
   return arclength
 
-"""You'll need to change the j in res[i, j] based on your dataset \\
-j = 1 for X \\
-j = 2 for P \\
-j = 3 for S \\
-j = 4 for E \\
-j = 5 for V \\
-"""
+def plot_fit(P, V, t, res):
+    """Overlay the data (green) and the fitted trajectory (red) in the P-V, P-t and V-t planes."""
+    import matplotlib.pyplot as plt
 
-error = []
-delt = 0.1
-tott = 8
-for i in combinations:
-  eta, kappa, eps = i
-  res,dxdt = michaelis_menten_kinetics(eta,kappa,eps,delt,tott)
-  index = [i for i in range(80)]
-  err = 0
-  err = np.float128(err)
-  for i in index:
-    err += (res[i, 2] - P[i])**2 # here change
-  error.append(err)
+    for xd, yd, xf, yf in ((P, V, res[:,2], res[:,5]),
+                           (P, t, res[:,2], t),
+                           (V, t, res[:,5], t)):
+        fig1, ax1 = plt.subplots()
+        ax2 = ax1.twinx()
+        ax1.plot(xd, yd, c='g')
+        ax2.plot(xf, yf, c='r')
+        ax2.set_ylim(ax1.get_ylim())
+        plt.show()
 
-"""This is your Eta, Kappa, Eps values"""
+if __name__ == '__main__':
+    import matplotlib.pyplot as plt
 
-combinations[error.index(min(error))]
+    """Change the plot variable based on your data."""
 
-"""This is the error value for the above parameters"""
+    plt.plot(P, V)
+    plt.xlabel("P")
+    plt.ylabel("V")
+    plt.title("Trajectory of Michaelis-Menten System")
+    plt.show()
 
-min(error)
+    delt = 0.1
+    tott = 8
+    combinations,error = michaelis_menten_grid(P,col=2,delt=delt,tott=tott) # here change
 
-"""Change the start and end values based on given dataset. \\
-Just plotting and seeing if the parameter look proper.
-"""
+    """This is your Eta, Kappa, Eps values"""
+
+    best = int(np.nanargmin(error))
+    print(combinations[best])
+
+    """This is the error value for the above parameters"""
+
+    print(error[best])
+
+    """Refine the grid optimum to full precision with Levenberg-Marquardt. \\
+    Use the same col as in the grid above.
+    """
+
+    p_lm,sigma_lm,corr_lm,redX2_lm = michaelis_menten_lm(P,combinations[best],col=2)
+    print(p_lm.T, sigma_lm, corr_lm)
+
+    """Change the start and end values based on given dataset. \\
+    Just plotting and seeing if the parameter look proper.
+    """
+
+    eta, kappa, eps = combinations[best]
+    start = 2
+    end = 48
+    res,dxdt = michaelis_menten_kinetics(eta,kappa,eps,delt,tott)
+    arclen = arclength(start, end,res)
+    plot_fit(P, V, t, res)
+
+    """This is your arclength."""
 
-eta, kappa, eps = combinations[error.index(min(error))]
-start = 2
-end = 48
-res,dxdt = michaelis_menten_kinetics(eta,kappa,eps,delt,tott)
-arclen = arclength(start, end,res)
-fig1, ax1 = plt.subplots()
-ax2 = ax1.twinx()
-ax1.plot(P, V, c='g')
-ax2.plot(res[:,2], res[:, 5],  c='r')
-ax2.set_ylim(ax1.get_ylim())
-plt.show()
-fig1, ax1 = plt.subplots()
-ax2 = ax1.twinx()
-ax1.plot(P, t, c='g')
-ax2.plot(res[:,2], t,  c='r')
-ax2.set_ylim(ax1.get_ylim())
-plt.show()
-fig1, ax1 = plt.subplots()
-ax2 = ax1.twinx()
-ax1.plot(V, t, c='g')
-ax2.plot(res[:,5], t,  c='r')
-ax2.set_ylim(ax1.get_ylim())
-plt.show()
-
-"""This is your arclength."""
-
-arclen
+    print(arclen)
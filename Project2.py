@@ -7,13 +7,19 @@ Original file is located at
     https://colab.research.google.com/drive/1ojTi4HuSkvsCe4nib6Xx7G2ZezEZ9aCY
 """
 
+import sys
+
 import numpy as np
-import pandas as pd
+
+import instrument
 
 def readc(file_path):
+    import pandas as pd
+
     df = pd.read_csv(file_path, header=None, names=['No', 'X', 'Y', 'Z'])
     return df[['X', 'Y', 'Z']].values
 
+@instrument.timed('solve')
 def solve(dna, prot, t=0):
     dna = np.array(dna)
     prot = np.array(prot)
@@ -25,6 +31,7 @@ def solve(dna, prot, t=0):
         visited_indices = np.where(d <= t)[0]
         v.extend(visited_indices)
     nv = len(v)
+    instrument.count('solve.distance_queries', len(prot) * len(dna))
 
     for step, p in enumerate(prot):
         d = np.linalg.norm(dna - p, axis=1)
@@ -32,10 +39,12 @@ def solve(dna, prot, t=0):
             fls = step + 1
             flp_index = np.argmin(d)
             flp = dna[flp_index]
+            instrument.count('solve.distance_queries', (step + 1) * len(dna))
             break
     else:
         fls = None
-        flp = None
+        flp_index = None
+        instrument.count('solve.distance_queries', len(prot) * len(dna))
 
 
     if len(set(v)) > 1:
@@ -45,14 +54,20 @@ def solve(dna, prot, t=0):
     else:
         mr = 0
 
-    return nv, flp_index + 1, fls, mr
+    if flp_index is not None:
+        flp_index = flp_index + 1
+
+    return nv, flp_index, fls, mr
 
-dna = readc('/content/DNA.csv')
-prot = readc('/content/PROTIEN.csv')
+if __name__ == '__main__':
+    dna_path = sys.argv[1] if len(sys.argv) > 1 else '/content/DNA.csv'
+    prot_path = sys.argv[2] if len(sys.argv) > 2 else '/content/PROTIEN.csv'
+    dna = readc(dna_path)
+    prot = readc(prot_path)
 
-nv, flp, fls, mr = solve(dna, prot)
+    nv, flp, fls, mr = solve(dna, prot)
 
-print(f"Total site visits: {nv}")
-print(f"First landing position index: {flp}")
-print(f"First landing step: {fls}")
-print(f"Max range: {mr}")
+    print(f"Total site visits: {nv}")
+    print(f"First landing position index: {flp}")
+    print(f"First landing step: {fls}")
+    print(f"Max range: {mr}")
@@ -1,8 +1,13 @@
 # -*- coding: utf-8 -*-
 
 
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 
+import instrument
+
 inda = np.array([[6, 4, 3], [5,3,4], [4,4,3], [3,5,4], [2,4,5], [3,5,6],
                  [2,6,5], [1,5,6], [0,4,5], [1,3,4], [0,2,3], [1,1,2],
                  [2,2,1], [3,1,2], [4,2,1], [5,3,0], [4,4,1], [3,5,0],
@@ -16,50 +21,209 @@ indb = np.array([[2,4,3], [3,5,2], [4, 6,1], [5,5,0], [4,4,1], [5,3,2],
                  [2,2,5]])
 
 comp = 6
-gymatrix = indb
-
-
-tr = 0
-cr = 0
-incr = 0
-num = 0
-
-
-data = []
-
-
-for i in range(len(inda)):
-    for j in range(len(indb)):
-        if np.array_equal(inda[i], indb[j]):
-            ra = i % comp
-            rb = j % comp
-            qa = i // comp
-            qb = j // comp
-
-            data.append([i, j, qa, qb, ra, rb])
-            num += 1
-
-            # Count the types of contacts
-            if qa == qb and ra == rb:
-                cr += 1
-            elif qa != qb and ra == rb:
-                tr += 1
-            else:
-                incr += 1
-
-gysum = 0
-n = len(gymatrix)
-for i in range(n - 1):
-    for j in range(i + 1, n):
-        gysum += ((gymatrix[i, 0] - gymatrix[j, 0]) ** 2 +
-                   (gymatrix[i, 1] - gymatrix[j, 1]) ** 2 +
-                   (gymatrix[i, 2] - gymatrix[j, 2]) ** 2)
-
-
-rad_gyr = np.sqrt(gysum) / 26
 
 
-print("Correct contact:", cr)
-print("Trapped contact:", tr)
-print("Incorrect contact:", incr)
-print("Radius of Gyration:", rad_gyr)
+@instrument.timed('contacts')
+def contacts(inda, indb, comp):
+    """
+    Shared lattice sites of two conformations, split by segment (i // comp)
+    and residue (i % comp) into correct, trapped and incorrect contacts.
+    """
+    tr = 0
+    cr = 0
+    incr = 0
+    num = 0
+
+    data = []
+
+    for i in range(len(inda)):
+        for j in range(len(indb)):
+            if np.array_equal(inda[i], indb[j]):
+                ra = i % comp
+                rb = j % comp
+                qa = i // comp
+                qb = j // comp
+
+                data.append([i, j, qa, qb, ra, rb])
+                num += 1
+
+                # Count the types of contacts
+                if qa == qb and ra == rb:
+                    cr += 1
+                elif qa != qb and ra == rb:
+                    tr += 1
+                else:
+                    incr += 1
+
+    instrument.count('contacts.comparisons', len(inda) * len(indb))
+    return cr, tr, incr, data
+
+
+@instrument.timed('radius_of_gyration')
+def radius_of_gyration(gymatrix, norm=26):
+    gysum = 0
+    n = len(gymatrix)
+    for i in range(n - 1):
+        for j in range(i + 1, n):
+            gysum += ((gymatrix[i, 0] - gymatrix[j, 0]) ** 2 +
+                       (gymatrix[i, 1] - gymatrix[j, 1]) ** 2 +
+                       (gymatrix[i, 2] - gymatrix[j, 2]) ** 2)
+
+    return np.sqrt(gysum) / norm
+
+
+def encode_conformations(confs):
+    """
+    Pack the lattice sites of every conformation into int64 keys, sorted
+    once per conformation. Conformation k owns keys[offsets[k]:offsets[k+1]]
+    and idx holds the residue index i of each key.
+    """
+    confs = [np.asarray(c, dtype=np.int64).reshape(-1, 3) for c in confs]
+    allc = np.concatenate(confs)
+    lo = allc.min(axis=0)
+    if np.any(allc.max(axis=0) - lo >= 1 << 21):
+        raise ValueError('lattice coordinates must span fewer than 2**21 sites per axis')
+
+    keys = []
+    idx = []
+    for c in confs:
+        k = ((c[:, 0] - lo[0]) << 42) | ((c[:, 1] - lo[1]) << 21) | (c[:, 2] - lo[2])
+        order = np.argsort(k, kind='stable')
+        keys.append(k[order])
+        idx.append(order)
+
+    offsets = np.zeros(len(confs) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(c) for c in confs])
+    return np.concatenate(keys), np.concatenate(idx), offsets
+
+
+def _block(enc, c0, c1):
+    keys, idx, offsets = enc
+    s0, s1 = offsets[c0], offsets[c1]
+    conf = np.repeat(np.arange(c1 - c0), np.diff(offsets[c0:c1 + 1]))
+    return keys[s0:s1], idx[s0:s1], conf
+
+
+def _pair_tile(enc, comp, r0, r1, c0, c1):
+    """Correct, trapped and incorrect counts of conformations r0:r1 against c0:c1."""
+    ka, ia, pa = _block(enc, r0, r1)
+    kb, ib, pb = _block(enc, c0, c1)
+    order = np.argsort(kb, kind='stable')
+    kb, ib, pb = kb[order], ib[order], pb[order]
+
+    # every (site of a, site of b) pair on the same lattice point
+    lo = np.searchsorted(kb, ka, 'left')
+    n = np.searchsorted(kb, ka, 'right') - lo
+    a = np.repeat(np.arange(len(ka)), n)
+    b = np.repeat(lo - (np.cumsum(n) - n), n) + np.arange(n.sum())
+
+    i = ia[a]
+    j = ib[b]
+    same_r = (i % comp) == (j % comp)
+    same_q = (i // comp) == (j // comp)
+
+    ncol = c1 - c0
+    size = (r1 - r0) * ncol
+    cell = pa[a] * ncol + pb[b]
+    num = np.bincount(cell, minlength=size)
+    cr = np.bincount(cell[same_r & same_q], minlength=size)
+    tr = np.bincount(cell[same_r & ~same_q], minlength=size)
+    instrument.count('contacts.pairs', size)
+    return cr.reshape(r1 - r0, ncol), tr.reshape(r1 - r0, ncol), (num - cr - tr).reshape(r1 - r0, ncol)
+
+
+def _pairs_row(enc, comp, r0, r1, tile):
+    """
+    Tiles of the row block r0:r1 on or above the diagonal, as triplets
+    (rows, cols, cr, tr, incr) of the pairs with row <= col and any contact.
+    """
+    N = len(enc[2]) - 1
+    out = []
+    for c0 in range(r0, N, tile):
+        c1 = min(c0 + tile, N)
+        cr, tr, incr = _pair_tile(enc, comp, r0, r1, c0, c1)
+        rows, cols = np.nonzero((cr + tr + incr) > 0)
+        keep = rows + r0 <= cols + c0
+        rows, cols = rows[keep], cols[keep]
+        out.append((rows + r0, cols + c0, cr[rows, cols], tr[rows, cols], incr[rows, cols]))
+    return tuple(np.concatenate(col) for col in zip(*out))
+
+
+_pairs_enc = None
+_pairs_comp = None
+
+
+def _pairs_init(enc, comp, enabled):
+    global _pairs_enc, _pairs_comp
+    _pairs_enc = enc
+    _pairs_comp = comp
+    instrument.init_worker(enabled)
+
+
+def _pairs_worker(r0, r1, tile):
+    return _pairs_row(_pairs_enc, _pairs_comp, r0, r1, tile), instrument.drain()
+
+
+@instrument.timed('contacts.all_pairs')
+def contacts_all_pairs(confs, comp, tile=64, n_workers=None, sparse=False):
+    """
+    Correct, trapped and incorrect contact counts, as defined in contacts(),
+    for every pair of conformations in the ensemble confs.
+
+    Each conformation is encoded once by encode_conformations; pairs are
+    compared tile x tile conformations at a time with a sorted-key join, so
+    memory is bounded by the tile, and row blocks of tiles run on a process
+    pool of n_workers (default os.cpu_count()). The matrices are symmetric
+    and the diagonal compares each conformation with itself.
+
+    Returns cr, tr, incr as dense (N x N) int arrays, or as
+    scipy.sparse.csr_matrix when sparse is True.
+    """
+    enc = encode_conformations(confs)
+    N = len(enc[2]) - 1
+    blocks = [(r0, min(r0 + tile, N)) for r0 in range(0, N, tile)]
+
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+
+    if n_workers == 1:
+        parts = [_pairs_row(enc, comp, r0, r1, tile) for r0, r1 in blocks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=_pairs_init,
+                                 initargs=(enc, comp, instrument.ENABLED)) as pool:
+            futures = [pool.submit(_pairs_worker, r0, r1, tile) for r0, r1 in blocks]
+            parts = []
+            for fut in futures:
+                part, rep = fut.result()
+                parts.append(part)
+                instrument.merge(rep)
+
+    rows, cols, cr, tr, incr = (np.concatenate(col) for col in zip(*parts))
+
+    if sparse:
+        from scipy.sparse import coo_matrix
+
+        # mirror the strict upper triangle
+        off = rows != cols
+        r = np.concatenate([rows, cols[off]])
+        c = np.concatenate([cols, rows[off]])
+        return tuple(coo_matrix((np.concatenate([v, v[off]]), (r, c)), shape=(N, N)).tocsr()
+                     for v in (cr, tr, incr))
+
+    out = []
+    for v in (cr, tr, incr):
+        m = np.zeros((N, N), dtype=np.int64)
+        m[rows, cols] = v
+        m[cols, rows] = v
+        out.append(m)
+    return tuple(out)
+
+
+if __name__ == '__main__':
+    cr, tr, incr, data = contacts(inda, indb, comp)
+    rad_gyr = radius_of_gyration(indb)
+
+    print("Correct contact:", cr)
+    print("Trapped contact:", tr)
+    print("Incorrect contact:", incr)
+    print("Radius of Gyration:", rad_gyr)
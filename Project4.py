@@ -1,79 +1,224 @@
 # -*- coding: utf-8 -*-
 
 
-tau_t = [0.244724, 0.260536, 0.275872, 0.290804, 0.305404, 0.319716, 0.333782, 0.347617, 0.361265, 0.37474, 0.388071, 0.401271, 0.414356, 0.427341, 0.440238, 0.453064, 0.465817, 0.478499, 0.491151, 0.503746, 0.516312, 0.528863, 0.541371, 0.553879, 0.566373, 0.578853, 0.591346, 0.603826, 0.616319, 0.628842, 0.641365, 0.653916, 0.666482, 0.679077, 0.691715, 0.704367, 0.717077, 0.729816, 0.742613, 0.755438, 0.768336, 0.781277, 0.794276, 0.807332, 0.820446, 0.833632, 0.846891, 0.860221, 0.873624, 0.887099, 0.90066, 0.914308, 0.928042, 0.941878, 0.9558, 0.969837, 0.983961, 0.998201, 1.01256, 1.02703, 1.04161, 1.05634, 1.0712, 1.08619, 1.10134, 1.11665, 1.13211, 1.14775, 1.16358, 1.17961, 1.19584, 1.21228, 1.22897, 1.24593, 1.26317, 1.28069, 1.29856, 1.31679, 1.3354, 1.35447, 1.37402, 1.39413, 1.41487, 1.4363, 1.45855, 1.48175, 1.50606];
-rin=0.09:0.01:0.95;
-dt=1e-5;
-Ps=1;
-errorbest = 1e5;
-vbest=0;
-hillbest=0;
-wbest=0;
-sigmabest=0;
-mubest=0;
-value = 1; %change this to according to the value given P = 1 or M=2....
-calc = 1;
-
-for hill=1:1:10
-    disp(hill);
-   for mu=0.001:0.001:0.01
-        for v=0.0001:0.0001:0.001
-            for w=0.1:0.1:1
-                for sigma=1:1:10
-                    rt = responsetimeneg(v,w,mu,sigma,hill,dt,1e-6,rin,value);
-                    error = sum((rt(:,2) - tau_t').^2);
-                    if error < errorbest
-                       errorbest=error;
-                       vbest=v;
-                       hillbest=hill;
-                       wbest=w;
-                       sigmabest=sigma;
-                       mubest=mu;
-
-                    end
-
-                end
-            end
-        end
-    end
-end
-
- disp([vbest,wbest,mubest,sigmabest,hillbest]);
-
- function ps = psteadystate(mu,hillc,tol)
-     tolc = 1e5; ps = 0.1;
-     while tolc > tol
-         pt = ps;
-         ps = ps + (mu-ps*(mu+ps^hillc)) / (mu+(hillc)*ps^(hillc - 1));
-         tolc = abs(pt-ps);
-     end
- end
-
-function ret = responsetimeneg(v,w,mu,sigma,hill,dt,tol,r,optmp)
-    ps = psteadystate(mu,hill,tol); xs = ps/(mu+ps^hill); ms = 1-xs;
-    ret = zeros(length(r),2); ret(:,1) = r;
-    xt = 0; mt = 0; pt = 0; tau = 0; stat = 0; q = 1;
-    while stat == 0
-        xt = xt + (((1-xt)*(pt^hill)-mu*xt)/v)*dt;
-        mt = mt + (1-xt-mt)*dt/w;
-        pt = pt + (mt-pt-sigma*((1-xt)*(pt^hill)-mu*xt))*dt;
-        tau = tau + dt;
-        if optmp == 1
-            if pt >= r(q)*ps
-                ret(q,2) = tau/log(2);
-                q = q + 1;
-                if q > length(r)
-                    stat = 1;
-                end
-            end
-        elseif optmp == 2
-           if mt >= r(q)*ms
-                ret(q,2) = tau/log(2);
-                q = q + 1;
-                if q > length(r)
-                    stat = 1;
-                end
-            end
-        end
-    end
-end
+import hashlib
+import itertools
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import instrument
+
+tau_t = [0.244724, 0.260536, 0.275872, 0.290804, 0.305404, 0.319716, 0.333782, 0.347617, 0.361265, 0.37474, 0.388071, 0.401271, 0.414356, 0.427341, 0.440238, 0.453064, 0.465817, 0.478499, 0.491151, 0.503746, 0.516312, 0.528863, 0.541371, 0.553879, 0.566373, 0.578853, 0.591346, 0.603826, 0.616319, 0.628842, 0.641365, 0.653916, 0.666482, 0.679077, 0.691715, 0.704367, 0.717077, 0.729816, 0.742613, 0.755438, 0.768336, 0.781277, 0.794276, 0.807332, 0.820446, 0.833632, 0.846891, 0.860221, 0.873624, 0.887099, 0.90066, 0.914308, 0.928042, 0.941878, 0.9558, 0.969837, 0.983961, 0.998201, 1.01256, 1.02703, 1.04161, 1.05634, 1.0712, 1.08619, 1.10134, 1.11665, 1.13211, 1.14775, 1.16358, 1.17961, 1.19584, 1.21228, 1.22897, 1.24593, 1.26317, 1.28069, 1.29856, 1.31679, 1.3354, 1.35447, 1.37402, 1.39413, 1.41487, 1.4363, 1.45855, 1.48175, 1.50606]
+rin = np.arange(9, 96)/100
+dt = 1e-5
+value = 1 # change this to according to the value given P = 1 or M = 2....
+
+# on-disk cache of response-time curves, shared by all worker processes
+RT_CACHE_DIR = os.environ.get('RT_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'responsetime'))
+RT_CACHE_MAX_BYTES = 256 * 2**20
+# evict down to 90% of the limit every this many writes to a cache directory,
+# counted across processes in its write log, and on each process's first write
+RT_CACHE_EVICT_EVERY = 256
+RT_CACHE_LOG = 'writes.log'
+# temporary files older than this (seconds) belong to a killed writer
+RT_CACHE_TMP_AGE = 600
+_rt_cache_seen = set()
+
+
+def psteadystate(mu,hillc,tol):
+    tolc = 1e5; ps = 0.1
+    while tolc > tol:
+        pt = ps
+        ps = ps + (mu-ps*(mu+ps**hillc)) / (mu+(hillc)*ps**(hillc - 1))
+        tolc = abs(pt-ps)
+    return ps
+
+
+@instrument.timed('rt.simulate')
+def responsetimeneg(v,w,mu,sigma,hill,dt,tol,r,optmp):
+    if optmp not in (1, 2):
+        raise ValueError('optmp must be 1 (P) or 2 (M)')
+    ps = psteadystate(mu,hill,tol); xs = ps/(mu+ps**hill); ms = 1-xs
+    ret = np.zeros((len(r),2)); ret[:,0] = r
+    r = [float(ri) for ri in r]
+    xt = 0.0; mt = 0.0; pt = 0.0; tau = 0.0; q = 0
+    while q < len(r):
+        xt = xt + (((1-xt)*(pt**hill)-mu*xt)/v)*dt
+        mt = mt + (1-xt-mt)*dt/w
+        pt = pt + (mt-pt-sigma*((1-xt)*(pt**hill)-mu*xt))*dt
+        tau = tau + dt
+        if optmp == 1:
+            if pt >= r[q]*ps:
+                ret[q,1] = tau/np.log(2)
+                q = q + 1
+        else:
+            if mt >= r[q]*ms:
+                ret[q,1] = tau/np.log(2)
+                q = q + 1
+    instrument.count('rt.simulations')
+    instrument.count('rt.steps', int(round(tau/dt)))
+    return ret
+
+
+def rt_cache_key(v,w,mu,sigma,hill,dt,tol,r,optmp):
+    """Hash of everything responsetimeneg depends on, used as the cache file name."""
+    h = hashlib.sha256(b'responsetimeneg-v1')
+    h.update(np.array([v,w,mu,sigma,hill,dt,tol,optmp], dtype=np.float64).tobytes())
+    h.update(np.ascontiguousarray(r, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+def rt_cache_evict(cache_dir=RT_CACHE_DIR, max_bytes=RT_CACHE_MAX_BYTES):
+    """
+    Delete .tmp files left by killed writers, then least recently used
+    curves until the cache is under 90% of max_bytes. Temporary files still
+    being written count towards the size.
+    """
+    entries = []
+    total = 0
+    stale = time.time() - RT_CACHE_TMP_AGE
+    with os.scandir(cache_dir) as it:
+        for e in it:
+            if not e.name.endswith(('.npy', '.tmp')):
+                continue
+            try:
+                st = e.stat()
+            except FileNotFoundError:
+                continue
+            if e.name.endswith('.tmp'):
+                if st.st_mtime < stale:
+                    try:
+                        os.remove(e.path)
+                    except FileNotFoundError:
+                        pass
+                    else:
+                        instrument.count('rt_cache.stale_tmp')
+                else:
+                    total += st.st_size
+                continue
+            entries.append((st.st_mtime, st.st_size, e.path))
+            total += st.st_size
+    if total <= max_bytes:
+        return
+    entries.sort()
+    for mtime, size, path in entries:
+        if total <= 0.9*max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # another process evicted it first
+            pass
+        else:
+            instrument.count('rt_cache.evictions')
+        total -= size
+
+
+def _rt_cache_log_write(cache_dir):
+    """
+    Append one byte to the write log of cache_dir and return the log length
+    after it. O_APPEND makes every process's append land at its own offset,
+    so the count is shared by all writers of the directory.
+    """
+    fd = os.open(os.path.join(cache_dir, RT_CACHE_LOG), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, b'.')
+        return os.lseek(fd, 0, os.SEEK_CUR)
+    finally:
+        os.close(fd)
+
+
+def responsetimeneg_cached(v,w,mu,sigma,hill,dt,tol,r,optmp,cache_dir=RT_CACHE_DIR,max_bytes=RT_CACHE_MAX_BYTES):
+    """
+    responsetimeneg backed by an on-disk cache of .npy curves keyed by
+    rt_cache_key. Writes go through a temporary file and os.replace, so
+    concurrent readers never see a partial curve; hits refresh the file
+    mtime, which is the recency used for LRU eviction. The size bound is
+    checked on disk every RT_CACHE_EVICT_EVERY writes by any process, so it
+    overshoots by at most that many curves however many workers write.
+    """
+    path = os.path.join(cache_dir, rt_cache_key(v,w,mu,sigma,hill,dt,tol,r,optmp) + '.npy')
+    try:
+        ret = np.load(path)
+    except (OSError, ValueError, EOFError):
+        # missing, evicted under us, truncated or unreadable: recompute
+        instrument.count('rt_cache.misses')
+    else:
+        try:
+            os.utime(path)
+        except OSError:
+            # evicted since the load; the curve is still good
+            pass
+        instrument.count('rt_cache.hits')
+        return ret
+
+    ret = responsetimeneg(v,w,mu,sigma,hill,dt,tol,r,optmp)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, ret)
+        os.replace(tmp, path)
+    except OSError:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return ret
+
+    try:
+        due = _rt_cache_log_write(cache_dir) >= RT_CACHE_EVICT_EVERY
+    except OSError:
+        due = False
+    if due:
+        # restart the count; appends racing the truncate are just not counted
+        try:
+            os.truncate(os.path.join(cache_dir, RT_CACHE_LOG), 0)
+        except OSError:
+            pass
+    if due or cache_dir not in _rt_cache_seen:
+        _rt_cache_seen.add(cache_dir)
+        rt_cache_evict(cache_dir, max_bytes)
+    return ret
+
+
+def _rt_error(args):
+    hill,mu,v,w,sigma,tau_t,rin,value,dt,tol,cache_dir = args
+    rt = responsetimeneg_cached(v,w,mu,sigma,hill,dt,tol,rin,value,cache_dir)
+    return np.sum((rt[:,1] - tau_t)**2), instrument.drain()
+
+
+@instrument.timed('rt.scan')
+def responsetime_scan(tau_t,rin,value,dt=1e-5,tol=1e-6,cache_dir=RT_CACHE_DIR,n_workers=None,grid=None):
+    """
+    Grid search of (v, w, mu, sigma, hill) against tau_t on a process pool.
+    Curves already simulated for the same rin, dt and tol are cache hits,
+    so re-fitting a new tau_t over a scanned grid mostly reads from disk.
+    grid gives the (hill, mu, v, w, sigma) axes, by default 10 values each.
+    """
+    tau_t = np.asarray(tau_t, dtype=float)
+    if grid is None:
+        grid = (range(1,11),                 # hill
+                np.arange(1,11)*0.001,       # mu
+                np.arange(1,11)*0.0001,      # v
+                np.arange(1,11)*0.1,         # w
+                range(1,11))                 # sigma
+    grid = list(itertools.product(*grid))
+    jobs = [(hill,mu,v,w,sigma,tau_t,rin,value,dt,tol,cache_dir) for hill,mu,v,w,sigma in grid]
+    error = np.zeros(len(jobs))
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=instrument.init_worker,
+                             initargs=(instrument.ENABLED,)) as pool:
+        for k,(err,rep) in enumerate(pool.map(_rt_error, jobs, chunksize=64)):
+            error[k] = err
+            instrument.merge(rep)
+    best = int(np.argmin(error))
+    hill,mu,v,w,sigma = grid[best]
+    return v,w,mu,sigma,hill,error[best]
+
+
+if __name__ == '__main__':
+    vbest,wbest,mubest,sigmabest,hillbest,errorbest = responsetime_scan(tau_t,rin,value,dt)
+    print([vbest,wbest,mubest,sigmabest,hillbest])
@@ -1,10 +1,18 @@
 # -*- coding: utf-8 -*-
 
 
+import contextlib
+import io
+import os
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
-import scipy.stats
-from scipy.stats import t, f
 
+import instrument
+
+# number of lm calls in this process, the fit id of its trace rows
+fit_count = 0
 
 def lm_func(t,p):
     """
@@ -27,7 +35,32 @@ def lm_func(t,p):
     return y_hat
 
 
-def lm_FD_J(t,p,y,dp):
+def lm_func_jac(t,p):
+    """
+
+    Exact Jacobian dy/dp of lm_func.
+
+    Parameters
+    ----------
+    t     : independent variable values (m x 1)
+    p     : parameter values (n x 1)
+
+    Returns
+    -------
+    J     : Jacobian Matrix J(i,j)=dy(i)/dp(j) (m x n)
+
+    """
+
+    e1 = np.exp(-p[1,0]*t)
+    e2 = np.exp(p[3,0]*t)
+    e3 = np.exp(-p[5,0]*t)
+
+    J = np.column_stack([e1, -p[0,0]*t*e1, e2, p[2,0]*t*e2, e3, -p[4,0]*t*e3])
+
+    return J
+
+
+def lm_FD_J(t,p,y,dp,func=lm_func):
     """
 
     Computes partial derivates (Jacobian) dy/dp via finite differences.
@@ -41,6 +74,7 @@ def lm_FD_J(t,p,y,dp):
                 - dp(j)>0 central differences calculated
                 - dp(j)<0 one sided differences calculated
                 - dp(j)=0 sets corresponding partials to zero; i.e. holds p(j) fixed
+    func :   model function y_hat = func(t,p), defaults to lm_func
 
     Returns
     -------
@@ -68,7 +102,7 @@ def lm_FD_J(t,p,y,dp):
         p[j,0]   = ps[j,0] + del_[j,0]
 
         if del_[j,0] != 0:
-            y1 = lm_func(t,p)
+            y1 = func(t,p)
             func_calls = func_calls + 1
 
             if dp[j,0] < 0:
@@ -76,8 +110,8 @@ def lm_FD_J(t,p,y,dp):
                 J[:,j] = (y1-y)/del_[j,0]
             else:
                 # central difference, additional func call
-                p[j,0] = ps[j,0] - del_[j]
-                J[:,j] = (y1-lm_func(t,p)) / (2 * del_[j,0])
+                p[j,0] = ps[j,0] - del_[j,0]
+                J[:,j] = (y1-func(t,p)) / (2 * del_[j,0])
                 func_calls = func_calls + 1
 
         # restore p(j)
@@ -114,7 +148,7 @@ def lm_Broyden_J(p_old,y_old,J,p,y):
 
     return J
 
-def lm_matx(t,p_old,y_old,dX2,J,p,y_dat,weight,dp):
+def lm_matx(t,p_old,y_old,dX2,J,p,y_dat,weight,dp,func=lm_func,jac=None):
     """
     Evaluate the linearized fitting matrix, JtWJ, and vector JtWdy, and
     calculate the Chi-squared error function, Chi_sq used by Levenberg-Marquardt
@@ -135,6 +169,9 @@ def lm_matx(t,p_old,y_old,dX2,J,p,y_dat,weight,dp):
                   - dp(j)>0 central differences calculated
                   - dp(j)<0 one sided differences calculated
                   - dp(j)=0 sets corresponding partials to zero; i.e. holds p(j) fixed
+    func   :     model function y_hat = func(t,p), defaults to lm_func
+    jac    :     exact Jacobian J = jac(t,p) (m x n); when given it replaces
+                 finite differences and Broyden updates
 
     Returns
     -------
@@ -152,16 +189,22 @@ def lm_matx(t,p_old,y_old,dX2,J,p,y_dat,weight,dp):
     Npar   = len(p)
 
     # evaluate model using parameters 'p'
-    y_hat = lm_func(t,p)
+    y_hat = func(t,p)
 
     func_calls = func_calls + 1
 
-    if not np.remainder(iteration,2*Npar) or dX2 > 0:
+    if jac is not None:
+        # exact Jacobian
+        J = jac(t,p)
+        instrument.count('lm.jacobian_exact')
+    elif not np.remainder(iteration,2*Npar) or dX2 > 0:
         # finite difference
-        J = lm_FD_J(t,p,y_hat,dp)
+        J = lm_FD_J(t,p,y_hat,dp,func)
+        instrument.count('lm.jacobian_fd')
     else:
         # rank-1 update
         J = lm_Broyden_J(p_old,y_old,J,p,y_hat)
+        instrument.count('lm.jacobian_broyden')
 
     # residual error between model and data
     delta_y = np.array([y_dat - y_hat]).T
@@ -177,7 +220,8 @@ def lm_matx(t,p_old,y_old,dX2,J,p,y_dat,weight,dp):
     return JtWJ,JtWdy,Chi_sq,y_hat,J
 
 
-def lm(p,t,y_dat):
+@instrument.timed('lm')
+def lm(p,t,y_dat,func=lm_func,p_min=None,p_max=None,epsilon_1=1e-3,jac=None,MaxIter=76,lambda_0=5):
     """
 
     Levenberg Marquardt curve-fitting: minimize sum of weighted squared residuals
@@ -187,6 +231,14 @@ def lm(p,t,y_dat):
     p : initial guess of parameter values (n x 1)
     t : independent variables (used as arg to lm_func) (m x 1)
     y_dat : data to be fit by func(t,p) (m x 1)
+    func  : model function y_hat = func(t,p), defaults to lm_func
+    p_min : lower bounds for parameter values (n x 1), default -100*abs(p)
+    p_max : upper bounds for parameter values (n x 1), default 100*abs(p)
+    epsilon_1 : convergence tolerance for the gradient JtWdy
+    jac   : exact Jacobian J = jac(t,p) (m x n), default finite differences
+    MaxIter : maximum number of iterations
+    lambda_0 : initial damping; small values start close to Gauss-Newton,
+               for a warm start near the optimum
 
     Returns
     -------
@@ -202,8 +254,9 @@ def lm(p,t,y_dat):
 
     """
 
-    global iteration, func_calls
+    global iteration, func_calls, fit_count
 
+    fit_count = fit_count + 1
     # iteration counter
     iteration  = 0
     # running count of function evaluations
@@ -243,15 +296,14 @@ def lm(p,t,y_dat):
     #dp = [-0.001]
     dp = [10**(-5)]
     # lower bounds for parameter values
-    p_min = -100*abs(p)
+    if p_min is None:
+        p_min = -100*abs(p)
     # upper bounds for parameter values
-    p_max = 100*abs(p)
+    if p_max is None:
+        p_max = 100*abs(p)
 
-    MaxIter       = 76       # maximum number of iterations                       #change this value as per your dataset (ML iterations to reach tol)
-    epsilon_1     = 1e-3        # convergence tolerance for gradient
     epsilon_2     = 8.30462e-06 # convergence tolerance for parameters              #change this as per your dataset (tol to exit value)
     epsilon_4     = 1e-1        # determines acceptance of a L-M step
-    lambda_0      = 5        # initial value of damping paramter, lambda
     lambda_UP_fac = 5          # factor for increasing lambda
     lambda_DN_fac = 5           # factor for decreasing lambda
     Update_Type   = 1           # 1: Levenberg-Marquardt lambda update, 2: Quadratic update, 3: Nielsen's lambda update equations
@@ -270,7 +322,7 @@ def lm(p,t,y_dat):
         weight = abs(weight)
 
     # initialize Jacobian with finite difference calculation
-    JtWJ,JtWdy,X2,y_hat,J = lm_matx(t,p_old,y_old,1,J,p,y_dat,weight,dp)
+    JtWJ,JtWdy,X2,y_hat,J = lm_matx(t,p_old,y_old,1,J,p,y_dat,weight,dp,func,jac)
     if np.abs(JtWdy).max() < epsilon_1:
         print('*** Your Initial Guess is Extremely Close to Optimal ***')
 
@@ -306,7 +358,7 @@ def lm(p,t,y_dat):
         p_try = np.minimum(np.maximum(p_min,p_try),p_max)
 
         # residual error using p_try
-        delta_y = np.array([y_dat - lm_func(t,p_try)]).T
+        delta_y = np.array([y_dat - func(t,p_try)]).T
 
         # floating point error; break
         if not all(np.isfinite(delta_y)):
@@ -317,7 +369,11 @@ def lm(p,t,y_dat):
         # Chi-squared error criteria
         X2_try = delta_y.T @ ( delta_y * weight )
 
-        rho = np.matmul( h.T @ (lambda_ * h + JtWdy),np.linalg.inv(X2 - X2_try))
+        # no change in Chi-squared, e.g. refitting from the optimum: not better
+        if (X2 - X2_try).item() == 0:
+            rho = np.zeros((1,1))
+        else:
+            rho = np.matmul( h.T @ (lambda_ * h + JtWdy),np.linalg.inv(X2 - X2_try))
         # it IS significantly better
         if ( rho > epsilon_4 ):
 
@@ -328,7 +384,7 @@ def lm(p,t,y_dat):
             # % accept p_try
             p = p_try
 
-            JtWJ,JtWdy,X2,y_hat,J = lm_matx(t,p_old,y_old,dX2,J,p,y_dat,weight,dp)
+            JtWJ,JtWdy,X2,y_hat,J = lm_matx(t,p_old,y_old,dX2,J,p,y_dat,weight,dp,func,jac)
 
             # % decrease lambda ==> Gauss-Newton method
             # % Levenberg
@@ -348,7 +404,7 @@ def lm(p,t,y_dat):
             X2 = X2_old
 
             if not np.remainder(iteration,2*Npar):
-                JtWJ,JtWdy,dX2,y_hat,J = lm_matx(t,p_old,y_old,-1,J,p,y_dat,weight,dp)
+                JtWJ,JtWdy,dX2,y_hat,J = lm_matx(t,p_old,y_old,-1,J,p,y_dat,weight,dp,func,jac)
 
             # % increase lambda  ==> gradient descent method
             # % Levenberg
@@ -358,11 +414,16 @@ def lm(p,t,y_dat):
 
         # update convergence history ... save _reduced_ Chi-square
         cvg_hst[iteration-1,0] = func_calls
-        cvg_hst[iteration-1,1] = X2/DoF
+        cvg_hst[iteration-1,1] = np.asarray(X2/DoF).item()
 
         for i in range(Npar):
             cvg_hst[iteration-1,i+2] = p.T[0][i]
 
+        if instrument.ENABLED:
+            instrument.trace('lm', fit=fit_count, iteration=iteration, func_calls=func_calls,
+                             redX2=np.asarray(X2/DoF).item(), lambda_=np.asarray(lambda_).item(),
+                             rho=np.asarray(rho).item(), accepted=bool(rho > epsilon_4))
+
         if ( max(abs(JtWdy)) < epsilon_1  and  iteration > 2 ):
           print('**** Convergence in r.h.s. ("JtWdy")  ****')
           stop = 1
@@ -386,7 +447,7 @@ def lm(p,t,y_dat):
     # % reduced Chi-square
     redX2 = X2 / DoF
 
-    JtWJ,JtWdy,X2,y_hat,J = lm_matx(t,p_old,y_old,-1,J,p,y_dat,weight,dp)
+    JtWJ,JtWdy,X2,y_hat,J = lm_matx(t,p_old,y_old,-1,J,p,y_dat,weight,dp,func,jac)
 
     # standard error of parameters
     covar_p = np.linalg.inv(JtWJ)
@@ -402,7 +463,7 @@ def lm(p,t,y_dat):
     sigma_y = np.sqrt(sigma_y)
 
     # parameter correlation matrix
-    corr_p = covar_p / [sigma_p@sigma_p.T]
+    corr_p = covar_p / np.outer(sigma_p,sigma_p)
 
     # coefficient of multiple determination
     R_sq = np.correlate(y_dat, y_hat)
@@ -411,6 +472,9 @@ def lm(p,t,y_dat):
     # convergence history
     cvg_hst = cvg_hst[:iteration,:]
 
+    instrument.count('lm.iterations',iteration)
+    instrument.count('lm.model_evals',func_calls)
+
     print('\nLM fitting results:')
     for i in range(Npar):
         print('----------------------------- ')
@@ -420,13 +484,12 @@ def lm(p,t,y_dat):
 
     return p,redX2,sigma_p,sigma_y,corr_p,R_sq,cvg_hst, JtWJ, inv
 
-import numpy as np
-import matplotlib.pyplot as plt
-
-def main(x,y,p_init):
+def main(x,y,p_init,MaxIter=1000):
     """
 
-    Main function for performing Levenberg-Marquardt curve fitting.
+    Main function for performing Levenberg-Marquardt curve fitting. The fit
+    is run to convergence in the parameters with the exact Jacobian, as the
+    bootstrap refits are, so its estimate is the one lm_bootstrap expects.
 
     Parameters
     ----------
@@ -434,6 +497,7 @@ def main(x,y,p_init):
     y           : y-values of input data (m x 1), must be 2D array
     p_init      : initial guess of parameters values (n x 1), must be 2D array
                   n = 4 in this example
+    MaxIter     : maximum number of LM iterations
 
     Returns
     -------
@@ -451,11 +515,163 @@ def main(x,y,p_init):
 
 
     # minimize sum of weighted squared residuals with L-M least squares analysis
-    p_fit,Chi_sq,sigma_p,sigma_y,corr,R_sq,cvg_hst, JtWJ, inv = lm(p_init,x,y)
+    # the default gradient tolerance passes after 2-3 iterations under lm's
+    # 1/(y.y) weighting, so converge on the parameters instead
+    p_fit,Chi_sq,sigma_p,sigma_y,corr,R_sq,cvg_hst, JtWJ, inv = lm(p_init,x,y,epsilon_1=1e-12,jac=lm_func_jac,
+                                                                   MaxIter=MaxIter)
 
     return p_fit,Chi_sq,sigma_p,sigma_y,corr,R_sq,cvg_hst, JtWJ, inv
 
+
+def _lm_bootstrap_chunk(x,y,p_fit,y_fit,resid,method,first,seeds,max_iter):
+    """
+
+    Refit one chunk of bootstrap replicates, warm-started from p_fit with
+    little damping since they start close to their optimum. Each
+    replicate draws from its own seed, so the resamples do not depend on
+    how the replicates are chunked. Replicate first+k draws from seeds[k]
+    and labels its lm trace rows replicate=first+k.
+
+    Returns
+    -------
+    p_rep : fitted parameters of each replicate, NaN where lm failed or did
+            not converge within max_iter iterations (n_rep x n)
+
+    """
+
+    Npnt = len(y)
+    p_rep = np.full((len(seeds),len(p_fit)),np.nan)
+
+    for k,seed in enumerate(seeds):
+        idx = np.random.default_rng(seed).integers(0,Npnt,Npnt)
+        if method == 'residual':
+            # resample residuals, keep the design points fixed
+            x_b = x
+            y_b = y_fit + resid[idx]
+        else:
+            # resample (x, y) cases
+            x_b = x[idx]
+            y_b = y[idx]
+
+        try:
+            # lm reports every fit; keep the workers quiet. Same convergence
+            # settings as main, which produced p_fit
+            with contextlib.redirect_stdout(io.StringIO()), instrument.label(replicate=first+k):
+                out = lm(p_fit.copy(),x_b,y_b,epsilon_1=1e-12,jac=lm_func_jac,MaxIter=max_iter,
+                         lambda_0=1e-3)
+        except np.linalg.LinAlgError:
+            # singular JtWJ, counted as a failed replicate by lm_bootstrap
+            continue
+
+        p_b,cvg_hst = out[0],out[6]
+        if len(cvg_hst) < max_iter:
+            p_rep[k,:] = p_b[:,0]
+
+    return p_rep
+
+
+def _lm_bootstrap_init(enabled):
+    global fit_count
+    instrument.init_worker(enabled)
+    fit_count = 0
+
+
+def _lm_bootstrap_worker(*args):
+    return _lm_bootstrap_chunk(*args), instrument.drain()
+
+
+@instrument.timed('lm.bootstrap')
+def lm_bootstrap(x,y,p_fit,n_boot=1000,method='residual',alpha=0.05,n_workers=None,seed=None,max_iter=1000):
+    """
+
+    Bootstrap confidence intervals and covariance of the LM parameters.
+
+    Each replicate is refit to convergence with lm and the exact Jacobian
+    lm_func_jac, warm-started from p_fit, and the replicates are spread
+    across a process pool in chunks. The replicates are centred on p_fit,
+    so it must be the converged estimate from main, not an early-stopped
+    lm fit; the intervals then describe the same estimator as p_fit.
+
+    Parameters
+    ----------
+    x         : x-values of input data (m,)
+    y         : y-values of input data (m,)
+    p_fit     : converged least-squares estimate of the parameters from
+                main (n x 1)
+    n_boot    : number of bootstrap replicates
+    method    : 'residual' resamples the residuals of the fit around y_hat,
+                'case' resamples the (x, y) pairs
+    alpha     : significance level, intervals cover 1-alpha
+    n_workers : number of worker processes (default os.cpu_count())
+    seed      : seed for the random resampling; intervals are reproducible
+                for any n_workers
+    max_iter  : iteration limit of each refit; replicates reaching it are
+                counted as failed
+
+    Returns
+    -------
+    p_low    : lower percentile bound of the parameters (n x 1)
+    p_high   : upper percentile bound of the parameters (n x 1)
+    cov_boot : bootstrap covariance matrix of the parameters (n x n)
+    p_boot   : fitted parameters of the successful replicates (n_ok x n)
+    n_fail   : number of replicates dropped because lm failed, did not
+               converge or returned non-finite parameters; a warning is
+               issued when non-zero
+
+    """
+
+    if method not in ('residual','case'):
+        raise ValueError("method must be 'residual' or 'case'")
+
+    x = np.asarray(x,dtype=float)
+    y = np.asarray(y,dtype=float)
+    p_fit = np.asarray(p_fit,dtype=float).reshape(-1,1)
+
+    y_fit = lm_func(x,p_fit)
+    resid = y - y_fit
+    resid = resid - resid.mean()
+
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+
+    # one seed per replicate; a few chunks per worker keeps the pool busy
+    # without paying IPC per fit
+    seeds = np.random.SeedSequence(seed).spawn(n_boot)
+    n_chunks = max(1,min(n_boot,4*n_workers))
+    bounds = np.linspace(0,n_boot,n_chunks+1).astype(int)
+    seed_chunks = [(int(a),seeds[a:b]) for a,b in zip(bounds[:-1],bounds[1:])]
+
+    if n_workers == 1:
+        chunks = [_lm_bootstrap_chunk(x,y,p_fit,y_fit,resid,method,a,s,max_iter) for a,s in seed_chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers,initializer=_lm_bootstrap_init,
+                                 initargs=(instrument.ENABLED,)) as pool:
+            futures = [pool.submit(_lm_bootstrap_worker,x,y,p_fit,y_fit,resid,method,a,s,max_iter)
+                       for a,s in seed_chunks]
+            chunks = []
+            for fut in futures:
+                p_rep,rep = fut.result()
+                chunks.append(p_rep)
+                instrument.merge(rep)
+
+    p_boot = np.vstack(chunks)
+    p_boot = p_boot[np.all(np.isfinite(p_boot),axis=1)]
+    n_fail = n_boot - len(p_boot)
+    if n_fail:
+        warnings.warn('%i of %i bootstrap replicates failed or did not converge and were dropped'
+                      % (n_fail,n_boot))
+    if len(p_boot) < 2:
+        raise RuntimeError('Too few bootstrap replicates converged')
+
+    p_low = np.percentile(p_boot,100*alpha/2,axis=0).reshape(-1,1)
+    p_high = np.percentile(p_boot,100*(1-alpha/2),axis=0).reshape(-1,1)
+    cov_boot = np.cov(p_boot,rowvar=False)
+
+    return p_low,p_high,cov_boot,p_boot,n_fail
+
 if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+    from scipy.stats import t
 
     # flag for making noisy test data
     make_test_data = False
@@ -481,29 +697,34 @@ if __name__ == '__main__':
     ax1.scatter(x, y, c='r', marker='o')
     plt.show()
 
-delta_y = np.array([y - lm_func(x,p_fit)]).T
-sse = 0
-for i in delta_y:
-  sse += i**2
-p = 6
-n = 150
-sigma_sq = sse / (n - p)
-cov_beta = inv*sigma_sq
-cov_beta
-
-p_fit_low = np.zeros((6,1))
-p_fit_high = np.zeros((6,1))
-for i in range(6):
-  p_fit_low[i, 0] = p_fit[i, 0] - abs(t.ppf(alpha/2, 144)) * np.sqrt(cov_beta[i, i])
-  p_fit_high[i, 0] = p_fit[i, 0] + abs(t.ppf(alpha/2, 144)) * np.sqrt(cov_beta[i, i])
-# p_fit_low
-# p_fit_high
-
-JtWJ[0, 4] #put index of JTJ matrix
-
-inv[2, 0] #put index of JTJ Inverse matrix
-
-cov_beta[1,3] #put index of cov beta matrix
-
-p_fit_low[1] #put index of Kth parameter (if low is asked)
-
+    delta_y = np.array([y - lm_func(x,p_fit)]).T
+    sse = (delta_y.T @ delta_y)[0,0]
+    p = len(p_fit)
+    n = len(y)
+    dof = n - p
+    sigma_sq = sse / dof
+    cov_beta = inv*sigma_sq
+    cov_beta
+
+    p_fit_low = np.zeros((p,1))
+    p_fit_high = np.zeros((p,1))
+    for i in range(p):
+      p_fit_low[i, 0] = p_fit[i, 0] - abs(t.ppf(alpha/2, dof)) * np.sqrt(cov_beta[i, i])
+      p_fit_high[i, 0] = p_fit[i, 0] + abs(t.ppf(alpha/2, dof)) * np.sqrt(cov_beta[i, i])
+    # p_fit_low
+    # p_fit_high
+
+    # bootstrap percentile intervals, method='case' to resample (x, y) pairs
+    p_boot_low,p_boot_high,cov_boot,p_boot,n_boot_fail = lm_bootstrap(x,y,p_fit,n_boot=1000,
+                                                                      method='residual',alpha=alpha,seed=0)
+    # p_boot_low
+    # p_boot_high
+    # cov_boot
+
+    JtWJ[0, 4] #put index of JTJ matrix
+
+    inv[2, 0] #put index of JTJ Inverse matrix
+
+    cov_beta[1,3] #put index of cov beta matrix
+
+    p_fit_low[1] #put index of Kth parameter (if low is asked)
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""
+Reproducible benchmarks for the five projects on synthetic workloads.
+
+Each case generates its data from a fixed seed, times the hot function a
+few times and records the best and median wall-clock time. Results are
+written as JSON so two commits can be compared:
+
+    python bench.py --scale small --out before.json
+    python bench.py --scale small --out after.json
+    python bench.py --compare before.json after.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+
+# problem sizes per scale; production sizes are 'large'
+SCALES = {
+    'small':  {'p1_grid': [3, 5],         'p2_dna': [10**3, 10**4],         'p2_prot': 50,
+               'p3_chain': [25, 100],     'p3_ensemble': 10,
+               'p4_dt': [1e-3, 1e-4],     'p4_scan': 2,       'p5_npnt': [150, 1000]},
+    'medium': {'p1_grid': [3, 5, 8],      'p2_dna': [10**3, 10**4, 10**5],  'p2_prot': 100,
+               'p3_chain': [25, 100, 400], 'p3_ensemble': 50,
+               'p4_dt': [1e-3, 1e-4, 1e-5], 'p4_scan': 3,     'p5_npnt': [150, 1000, 10000]},
+    'large':  {'p1_grid': [3, 5, 8, 15],  'p2_dna': [10**3, 10**4, 10**5, 10**6], 'p2_prot': 100,
+               'p3_chain': [25, 100, 400, 1600], 'p3_ensemble': 200,
+               'p4_dt': [1e-3, 1e-4, 1e-5], 'p4_scan': 4,     'p5_npnt': [150, 1000, 10000, 100000]},
+}
+
+
+def _timeit(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return {'best': min(times), 'median': float(np.median(times)), 'repeat': repeat}
+
+
+# ---- synthetic data generators ------------------------------------------ #
+
+def mm_data(eta=0.5, kappa=0.7, eps=0.9, delt=0.1, npnt=80, col=2, noise=1e-3, seed=0):
+    """Michaelis-Menten trajectory column with Gaussian noise."""
+    from Project1 import michaelis_menten_kinetics
+
+    res, dxdt = michaelis_menten_kinetics(eta, kappa, eps, delt, (npnt+1)*delt)
+    rng = np.random.default_rng(seed)
+    return res[:npnt, col] + noise*rng.standard_normal(npnt)
+
+
+def dna_protein_data(n_dna, n_prot, seed=0):
+    """
+    Integer DNA contour along x and a protein random walk that starts next
+    to it, so some steps land on DNA sites.
+    """
+    rng = np.random.default_rng(seed)
+    dna = np.zeros((n_dna, 3))
+    dna[:, 0] = np.arange(n_dna)
+    steps = rng.integers(-1, 2, size=(n_prot, 3))
+    prot = np.cumsum(steps, axis=0) + np.array([n_dna//2, 0, 0])
+    return dna, prot.astype(float)
+
+
+_LATTICE_MOVES = np.array([[1, 0, 0], [-1, 0, 0], [0, 1, 0],
+                           [0, -1, 0], [0, 0, 1], [0, 0, -1]])
+
+
+def lattice_chain(n, seed=0):
+    """Non-reversing random walk of n sites on the cubic lattice."""
+    rng = np.random.default_rng(seed)
+    chain = np.zeros((n, 3), dtype=int)
+    prev = -1
+    for i in range(1, n):
+        # never step straight back onto the previous site
+        move = rng.integers(6)
+        while prev >= 0 and move == prev ^ 1:
+            move = rng.integers(6)
+        chain[i] = chain[i-1] + _LATTICE_MOVES[move]
+        prev = move
+    return chain
+
+
+def lattice_ensemble(n, m, seed=0):
+    """m chains of n sites: a common walk with its tail shifted by one lattice step from a random site."""
+    rng = np.random.default_rng(seed)
+    base = lattice_chain(n, seed)
+    ensemble = []
+    for k in range(m):
+        chain = base.copy()
+        i = rng.integers(n)
+        chain[i:] += _LATTICE_MOVES[rng.integers(6)]
+        ensemble.append(chain)
+    return ensemble
+
+
+def sum_exp_data(npnt, p=(6.0, 2.0, 0.5, -1.0, 2.5, 4.0), noise=0.1, seed=0):
+    """Samples of Project5's three-exponential model on [0, 3)."""
+    from Project5 import lm_func
+
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 3, npnt, endpoint=False)
+    y = lm_func(x, np.array([p]).T) + noise*rng.standard_normal(npnt)
+    return x, y
+
+
+# ---- benchmark cases ---------------------------------------------------- #
+
+def bench_project1(cfg, repeat):
+    from Project1 import michaelis_menten_kinetics, michaelis_menten_grid
+
+    y_dat = mm_data()
+    out = [{'name': 'michaelis_menten_kinetics', 'size': 80,
+            **_timeit(lambda: michaelis_menten_kinetics(0.5, 0.7, 0.9, 0.1, 8), repeat)},
+           {'name': 'michaelis_menten_kinetics_sens', 'size': 80,
+            **_timeit(lambda: michaelis_menten_kinetics(0.5, 0.7, 0.9, 0.1, 8, sens=True), repeat)}]
+    for k in cfg['p1_grid']:
+        a = list(np.linspace(0.1, 1.5, k))
+        out.append({'name': 'michaelis_menten_grid', 'size': k**3,
+                    **_timeit(lambda: michaelis_menten_grid(y_dat, a), repeat)})
+    return out
+
+
+def bench_project2(cfg, repeat):
+    from Project2 import solve
+
+    out = []
+    for n in cfg['p2_dna']:
+        dna, prot = dna_protein_data(n, cfg['p2_prot'])
+        out.append({'name': 'solve', 'size': n,
+                    **_timeit(lambda: solve(dna, prot), repeat)})
+    return out
+
+
+def bench_project3(cfg, repeat):
+    from Project3 import contacts, contacts_all_pairs
+
+    out = []
+    for n in cfg['p3_chain']:
+        a, b = lattice_chain(n, seed=1), lattice_chain(n, seed=2)
+        out.append({'name': 'contacts', 'size': n,
+                    **_timeit(lambda: contacts(a, b, 6), repeat)})
+    m = cfg['p3_ensemble']
+    ensemble = lattice_ensemble(cfg['p3_chain'][0], m)
+    pairs = [(ensemble[i], ensemble[j]) for i in range(m) for j in range(i+1, m)]
+    out.append({'name': 'contacts_ensemble', 'size': m,
+                **_timeit(lambda: [contacts(a, b, 6) for a, b in pairs], repeat)})
+    out.append({'name': 'contacts_all_pairs', 'size': m,
+                **_timeit(lambda: contacts_all_pairs(ensemble, 6, n_workers=1), repeat)})
+    return out
+
+
+def bench_project4(cfg, repeat):
+    from Project4 import responsetimeneg, responsetime_scan, rin, tau_t
+
+    out = []
+    for dt in cfg['p4_dt']:
+        out.append({'name': 'responsetimeneg', 'size': dt,
+                    **_timeit(lambda: responsetimeneg(0.0005, 0.5, 0.005, 5, 2, dt, 1e-6, rin, 1), repeat)})
+
+    # k values per axis of the scan at the coarsest dt: the pool plus
+    # simulations into an empty cache (cold), then reads only (warm)
+    k = cfg['p4_scan']
+    grid = (range(1, k+1), np.arange(1, k+1)*0.001, np.arange(1, k+1)*0.0001,
+            np.arange(1, k+1)*0.1, range(1, k+1))
+    dirs = []
+
+    def scan(cache_dir):
+        return responsetime_scan(tau_t, rin, 1, cfg['p4_dt'][0], 1e-6, cache_dir, grid=grid)
+
+    def cold():
+        dirs.append(tempfile.mkdtemp(prefix='bench-rt-'))
+        scan(dirs[-1])
+
+    try:
+        out.append({'name': 'responsetime_scan_cold', 'size': k**5, **_timeit(cold, repeat)})
+        out.append({'name': 'responsetime_scan_warm', 'size': k**5,
+                    **_timeit(lambda: scan(dirs[-1]), repeat)})
+    finally:
+        for d in dirs:
+            shutil.rmtree(d, ignore_errors=True)
+    return out
+
+
+def bench_project5(cfg, repeat):
+    import Project5
+    from Project5 import lm, lm_func_jac
+
+    out = []
+    for n in cfg['p5_npnt']:
+        x, y = sum_exp_data(n)
+
+        def fit():
+            # converged, as main and the bootstrap refits run it; lm reports
+            # every fit, keep the benchmark output clean
+            with contextlib.redirect_stdout(io.StringIO()):
+                lm(np.array([[0.1, 1, 1, 1, 1, 1]]).T, x, y, epsilon_1=1e-12, jac=lm_func_jac, MaxIter=1000)
+
+        # the fit is deterministic, so the last run's counts hold for all of them
+        out.append({'name': 'lm', 'size': n, **_timeit(fit, repeat),
+                    'iterations': Project5.iteration, 'func_calls': Project5.func_calls})
+    return out
+
+
+BENCHMARKS = {
+    'project1': bench_project1,
+    'project2': bench_project2,
+    'project3': bench_project3,
+    'project4': bench_project4,
+    'project5': bench_project5,
+}
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(scale='small', only=None, repeat=3):
+    cfg = SCALES[scale]
+    results = []
+    for project, bench in BENCHMARKS.items():
+        if only and project not in only:
+            continue
+        for case in bench(cfg, repeat):
+            case['project'] = project
+            results.append(case)
+            print('%-10s %-28s %-10s %10.4f s' % (project, case['name'], case['size'], case['best']),
+                  file=sys.stderr)
+    return {'commit': _commit(), 'scale': scale, 'python': platform.python_version(),
+            'numpy': np.__version__, 'machine': platform.machine(), 'cpus': os.cpu_count(),
+            'results': results}
+
+
+def compare(old, new):
+    """
+    Print new/old ratios of the best time of every case present in both
+    files, flagging cases whose iteration count changed, where the ratio
+    reflects convergence rather than speed.
+    """
+    key = lambda c: (c['project'], c['name'], c['size'])
+    before = {key(c): c for c in old['results']}
+    print('%-10s %-28s %-10s %10s %10s %8s' % ('project', 'case', 'size', 'old', 'new', 'ratio'))
+    for c in new['results']:
+        if key(c) in before:
+            b = before[key(c)]
+            note = ''
+            if b.get('iterations') != c.get('iterations'):
+                note = '  iterations %s -> %s' % (b.get('iterations'), c.get('iterations'))
+            print('%-10s %-28s %-10s %10.4f %10.4f %8.2f%s' % (c['project'], c['name'], c['size'],
+                                                              b['best'], c['best'], c['best']/b['best'], note))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--scale', default='small', choices=sorted(SCALES))
+    parser.add_argument('--only', nargs='+', choices=sorted(BENCHMARKS))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--out', help='write results as JSON to this file (default stdout)')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as f_old, open(args.compare[1]) as f_new:
+            compare(json.load(f_old), json.load(f_new))
+        return
+
+    out = run(args.scale, args.only, args.repeat)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(out, f, indent=2)
+    else:
+        json.dump(out, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
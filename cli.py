@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Headless command line for the five projects. Every subcommand reads its
+inputs from files, runs the fit without plotting and prints the results
+as JSON on stdout; progress printed by the fitting code goes to stderr.
+
+    python cli.py project1 PV.csv --col 2
+    python cli.py project2 DNA.csv PROTIEN.csv
+    python cli.py project3 inda.txt indb.txt --comp 6
+    python cli.py project4 tau_t.txt --value 1
+    python cli.py project5 xy.csv --p-init 0.1 1 1 1 1 1 --bootstrap 1000
+
+--profile FILE records stage timers, counters and traces (see
+instrument.py) and writes them as JSON, or as CSV when FILE ends in .csv;
+each trace, e.g. the LM iterations, then goes to FILE.<trace>.csv next to
+it (x.csv -> x.lm.csv).
+"""
+
+import argparse
+import contextlib
+import json
+import sys
+
+
+def _load(path, ndmin=1):
+    import numpy as np
+
+    delimiter = ',' if path.endswith('.csv') else None
+    return np.loadtxt(path, delimiter=delimiter, ndmin=ndmin)
+
+
+def _jsonable(obj):
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    return obj
+
+
+def project1(args):
+    from Project1 import michaelis_menten_fit
+
+    y_dat = _load(args.data)
+    with contextlib.redirect_stdout(sys.stderr):
+        p_fit, sigma_p, corr_p, redX2 = michaelis_menten_fit(y_dat, args.grid, args.col, args.delt)
+    return {'eta': p_fit[0, 0], 'kappa': p_fit[1, 0], 'eps': p_fit[2, 0],
+            'sigma_p': sigma_p, 'corr_p': corr_p, 'redX2': redX2.item()}
+
+
+def project2(args):
+    from Project2 import readc, solve
+
+    nv, flp, fls, mr = solve(readc(args.dna), readc(args.prot), args.t)
+    return {'site_visits': nv, 'first_landing_position': flp,
+            'first_landing_step': fls, 'max_range': mr}
+
+
+def project3(args):
+    from Project3 import contacts, radius_of_gyration
+
+    inda = _load(args.inda, ndmin=2)
+    indb = _load(args.indb, ndmin=2)
+    cr, tr, incr, data = contacts(inda, indb, args.comp)
+    return {'correct': cr, 'trapped': tr, 'incorrect': incr,
+            'radius_of_gyration': radius_of_gyration(indb, args.norm)}
+
+
+def project4(args):
+    from Project4 import RT_CACHE_DIR, rin, responsetime_scan
+
+    tau_t = _load(args.tau_t)
+    r = _load(args.rin) if args.rin else rin
+    v, w, mu, sigma, hill, error = responsetime_scan(tau_t, r, args.value, args.dt, args.tol,
+                                                     args.cache_dir or RT_CACHE_DIR, args.workers)
+    return {'v': v, 'w': w, 'mu': mu, 'sigma': sigma, 'hill': hill, 'error': error}
+
+
+def project5(args):
+    import numpy as np
+    from Project5 import lm_bootstrap, main
+
+    xy = _load(args.data, ndmin=2)
+    x, y = xy[:, 0], xy[:, 1]
+    p_init = np.array([args.p_init], dtype=float).T
+    with contextlib.redirect_stdout(sys.stderr):
+        # converged fit, the estimator the bootstrap intervals are about
+        p_fit, redX2, sigma_p, sigma_y, corr_p, R_sq, cvg_hst, JtWJ, inv = main(x, y, p_init)
+    out = {'p_fit': p_fit[:, 0], 'redX2': redX2.item(), 'sigma_p': sigma_p, 'corr_p': corr_p}
+    if args.bootstrap:
+        p_low, p_high, cov_boot, p_boot, n_fail = lm_bootstrap(x, y, p_fit, args.bootstrap, args.method,
+                                                       args.alpha, args.workers, args.seed)
+        out.update({'p_boot_low': p_low[:, 0], 'p_boot_high': p_high[:, 0],
+                    'cov_boot': cov_boot, 'n_boot_ok': len(p_boot), 'n_boot_failed': n_fail})
+    return out
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--profile', metavar='FILE', help='write timers, counters and traces to FILE (.json or .csv)')
+    sub = parser.add_subparsers(dest='project', required=True)
+
+    p = sub.add_parser('project1', help='Michaelis-Menten grid + LM fit')
+    p.add_argument('data', help='observed series, one value per row')
+    p.add_argument('--col', type=int, default=2, help='1 X, 2 P, 3 S, 4 E, 5 V')
+    p.add_argument('--delt', type=float, default=0.1)
+    p.add_argument('--grid', type=float, nargs='+', default=[0.3, 0.8, 1.3],
+                   help='coarse grid values for each of eta, kappa, eps')
+    p.set_defaults(func=project1)
+
+    p = sub.add_parser('project2', help='DNA/protein site visits')
+    p.add_argument('dna', help='CSV of No,X,Y,Z')
+    p.add_argument('prot', help='CSV of No,X,Y,Z')
+    p.add_argument('--t', type=float, default=0)
+    p.set_defaults(func=project2)
+
+    p = sub.add_parser('project3', help='lattice contacts and radius of gyration')
+    p.add_argument('inda', help='n x 3 lattice coordinates')
+    p.add_argument('indb', help='n x 3 lattice coordinates')
+    p.add_argument('--comp', type=int, default=6)
+    p.add_argument('--norm', type=float, default=26)
+    p.set_defaults(func=project3)
+
+    p = sub.add_parser('project4', help='response-time parameter scan')
+    p.add_argument('tau_t', help='response times, one value per row')
+    p.add_argument('--rin', help='response levels, one value per row (default 0.09:0.01:0.95)')
+    p.add_argument('--value', type=int, default=1, choices=(1, 2), help='1 P, 2 M')
+    p.add_argument('--dt', type=float, default=1e-5)
+    p.add_argument('--tol', type=float, default=1e-6)
+    p.add_argument('--cache-dir')
+    p.add_argument('--workers', type=int)
+    p.set_defaults(func=project4)
+
+    p = sub.add_parser('project5', help='sum-of-exponentials LM fit')
+    p.add_argument('data', help='two columns x, y')
+    p.add_argument('--p-init', type=float, nargs='+', default=[0.1, 1, 1, 1, 1, 1])
+    p.add_argument('--bootstrap', type=int, default=0, help='number of bootstrap replicates')
+    p.add_argument('--method', default='residual', choices=('residual', 'case'))
+    p.add_argument('--alpha', type=float, default=0.05)
+    p.add_argument('--seed', type=int)
+    p.add_argument('--workers', type=int)
+    p.set_defaults(func=project5)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.profile:
+        import instrument
+        instrument.enable()
+    out = args.func(args)
+    if args.profile:
+        if args.profile.endswith('.csv'):
+            instrument.export_csv(args.profile)
+            for name in instrument.report()['traces']:
+                instrument.export_csv('%s.%s.csv' % (args.profile[:-4], name), trace=name)
+        else:
+            instrument.export_json(args.profile)
+    json.dump({k: _jsonable(v) for k, v in out.items()}, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
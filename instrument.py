@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Lightweight instrumentation shared by the projects: per-stage wall-clock
+timers, event counters and per-iteration traces.
+
+Off by default. Turn it on with enable() or BIOPHYS_INSTRUMENT=1 in the
+environment; while off, count() and trace() return immediately and timer()
+hands back a shared no-op context, so instrumented code pays one flag
+check. Hot loops count once per call (e.g. steps taken) rather than once
+per step. label() stamps trace rows with ids, e.g. of the fit or bootstrap
+replicate they belong to. Records are per process: pool workers started with
+initializer=init_worker hand theirs back with drain() and the parent
+folds them in with merge(). init_worker also clears whatever a forked
+worker inherited from the parent, which merge() would otherwise count
+twice.
+
+    import instrument
+    instrument.enable()
+    ...
+    instrument.export_json('profile.json')
+    instrument.export_csv('lm_trace.csv', trace='lm')
+"""
+
+import contextlib
+import csv
+import functools
+import json
+import os
+import time
+
+
+ENABLED = os.environ.get('BIOPHYS_INSTRUMENT', '') not in ('', '0')
+
+_timers = {}
+_counters = {}
+_traces = {}
+_labels = {}
+_null = contextlib.nullcontext()
+
+
+def enable():
+    global ENABLED
+    ENABLED = True
+
+
+def disable():
+    global ENABLED
+    ENABLED = False
+
+
+def set_enabled(flag):
+    global ENABLED
+    ENABLED = bool(flag)
+
+
+def reset():
+    _timers.clear()
+    _counters.clear()
+    _traces.clear()
+
+
+def init_worker(flag):
+    """Pool initializer: set_enabled(flag) and drop records and labels inherited from the parent."""
+    set_enabled(flag)
+    reset()
+    _labels.clear()
+
+
+@contextlib.contextmanager
+def _timed(stage):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        dt = time.perf_counter() - t0
+        rec = _timers.setdefault(stage, {'calls': 0, 'total': 0.0, 'max': 0.0})
+        rec['calls'] += 1
+        rec['total'] += dt
+        rec['max'] = max(rec['max'], dt)
+
+
+def timer(stage):
+    """Context manager adding the wall-clock time of the block to stage."""
+    if not ENABLED:
+        return _null
+    return _timed(stage)
+
+
+def timed(stage):
+    """Decorator form of timer() for whole functions."""
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return fn(*args, **kwargs)
+            with _timed(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return deco
+
+
+def count(name, n=1):
+    """Add n to counter name."""
+    if ENABLED:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def trace(name, **row):
+    """Append one row, e.g. one LM iteration, to trace name."""
+    if ENABLED:
+        _traces.setdefault(name, []).append({**_labels, **row} if _labels else row)
+
+
+@contextlib.contextmanager
+def _labelled(fields):
+    saved = dict(_labels)
+    _labels.update(fields)
+    try:
+        yield
+    finally:
+        _labels.clear()
+        _labels.update(saved)
+
+
+def label(**fields):
+    """Context manager adding fields, e.g. replicate=k, to every trace row recorded in the block."""
+    if not ENABLED:
+        return _null
+    return _labelled(fields)
+
+
+def report():
+    """Snapshot of everything recorded so far."""
+    return {'timers': {k: dict(v) for k, v in _timers.items()},
+            'counters': dict(_counters),
+            'traces': {k: list(v) for k, v in _traces.items()}}
+
+
+def drain():
+    """report() and reset(), or None while disabled; used by pool workers."""
+    if not ENABLED:
+        return None
+    rep = report()
+    reset()
+    return rep
+
+
+def merge(rep):
+    """Fold a drain() from another process into this one."""
+    if not rep:
+        return
+    for name, rec in rep['timers'].items():
+        mine = _timers.setdefault(name, {'calls': 0, 'total': 0.0, 'max': 0.0})
+        mine['calls'] += rec['calls']
+        mine['total'] += rec['total']
+        mine['max'] = max(mine['max'], rec['max'])
+    for name, n in rep['counters'].items():
+        _counters[name] = _counters.get(name, 0) + n
+    for name, rows in rep['traces'].items():
+        _traces.setdefault(name, []).extend(rows)
+
+
+def export_json(path):
+    with open(path, 'w') as f:
+        json.dump(report(), f, indent=2, default=float)
+
+
+def export_csv(path, trace=None):
+    """
+    Write timers and counters as kind,name,calls,total,max rows, or, when
+    trace is given, that trace with one column per recorded field.
+    """
+    with open(path, 'w', newline='') as f:
+        if trace is not None:
+            rows = _traces.get(trace, [])
+            fields = []
+            for row in rows:
+                fields.extend(k for k in row if k not in fields)
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(rows)
+            return
+        writer = csv.writer(f)
+        writer.writerow(['kind', 'name', 'calls', 'total', 'max'])
+        for name, rec in _timers.items():
+            writer.writerow(['timer', name, rec['calls'], rec['total'], rec['max']])
+        for name, n in _counters.items():
+            writer.writerow(['counter', name, n, '', ''])